@@ -8,16 +8,44 @@
 Interact with Gravitational Teleport
 '''
 import re
+import copy
+import json
 import yaml
 import time
 import logging
 import os
+import subprocess
 
 import salt.crypt
 import salt.exceptions
+import salt.utils.args
+
+try:
+    from yaml import CSafeLoader as _Loader
+except ImportError:
+    from yaml import SafeLoader as _Loader
 
 log = logging.getLogger(__name__)
 
+_NODES_ADD_RE = re.compile(
+    r'^(?:The invite token: (?P<token>[0-9a-f]{32})$'
+    r'|  - This invitation token will expire in (?P<n>[0-9]+) (?P<unit>\w+)'
+    r'|> (?P<cmd>.*)'
+    r'|.*--auth-server=(?P<auth>\S+))', re.MULTILINE)
+_UNIT_SECS = {'seconds': 1, 'minutes': 60, 'hours': 60 * 60, 'days': 24 * 60 * 60}
+
+_USERS_ADD_RE = re.compile(
+    r'^(?:Signup token has been created and is valid for (?P<expires>[^.\n]+)\. Share this'
+    r'|(?P<url>https://.*))', re.MULTILINE)
+
+# users_list results are reused for a few seconds so that a state run
+# checking many users does not shell out to tctl for every one of them
+_USERS_CACHE_TTL = 5
+_users_cache = {'ts': 0, 'data': None}
+
+# tctl prints its listings as tables whose columns are padded with spaces
+_COLUMN_SEP = '     '
+
 def __virtual__():
     '''
     Only load if tctl exists on the system
@@ -26,7 +54,143 @@ def __virtual__():
         return (False, 'The tctl execution module cannot be loaded: tctl unavailable.')
     else:
         return True
-        
+
+def _columns(line):
+    '''
+    Split a row of a tctl table into its non-empty, stripped fields
+    '''
+    return [field.strip() for field in line.split(_COLUMN_SEP) if field.strip()]
+
+def _tctl(args, ignore_retcode=False, redirect_stderr=False, **kwargs):
+    '''
+    Run a read-only tctl command and return it in the shape of cmd.run_all
+
+    tctl is executed directly, skipping the cmd module, when the minion
+    already runs as root and no extra cmd.run_all options such as env were
+    passed in. Otherwise it goes through cmd.run_all with runas=root.
+    '''
+    if os.geteuid() != 0 or salt.utils.args.clean_kwargs(**kwargs):
+        return __salt__['cmd.run_all'](
+            ' '.join(['tctl'] + list(args)),
+            cwd="/root",
+            runas="root",
+            python_shell=False,
+            ignore_retcode=ignore_retcode,
+            redirect_stderr=redirect_stderr,
+            **kwargs)
+
+    argv = ['tctl'] + list(args)
+    try:
+        proc = subprocess.run(
+            argv,
+            cwd="/root",
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT if redirect_stderr else subprocess.PIPE,
+            universal_newlines=True)
+    except OSError as exc:
+        raise salt.exceptions.CommandExecutionError(
+            "Unable to run command '{0}': {1}".format(' '.join(argv), exc))
+    return {
+        'retcode': proc.returncode,
+        'stdout': proc.stdout.rstrip(),
+        'stderr': (proc.stderr or '').rstrip()
+    }
+
+# The _parse_* helpers below are plain string and regex work. Do not
+# @numba.jit them: numba falls back to object mode for str processing
+# and ends up slower than CPython, and a short lived minion call never
+# amortises the compile time anyway.
+
+def _parse_nodes_add(stdout):
+    '''
+    Parse the output of ``tctl nodes add``
+    '''
+    result = {}
+    now = int(time.time())
+    # each alternative of the pattern ends in its own group, so lastgroup
+    # tells which kind of line matched without testing every group
+    for match in _NODES_ADD_RE.finditer(stdout):
+        kind = match.lastgroup
+
+        if kind == 'token':
+            result['token'] = match.group('token')
+        elif kind == 'unit':
+            n, unit = match.group('n', 'unit')
+            result['expires'] = '{0} {1}'.format(n, unit)
+            result['expires_at'] = now + int(n) * _UNIT_SECS.get(unit, 0)
+        elif kind == 'cmd':
+            command = match.group('cmd')
+            result['command'] = command
+            # the join command is also where the auth server is given
+            if '--auth-server=' in command:
+                result['auth_server'] = command.rpartition('--auth-server=')[2]
+        else:
+            result['auth_server'] = match.group('auth')
+    return result
+
+def _parse_nodes_list(stdout):
+    '''
+    Parse the table printed by ``tctl nodes ls``
+    '''
+    nodes = []
+    append = nodes.append
+    # skip the column headings and the rule underneath them
+    for line in stdout.splitlines()[2:]:
+        columns = _columns(line)
+        # _columns drops empty cells, so a node without labels has three
+        if len(columns) in (3, 4):
+            append({
+                'node_name': columns[0],
+                'node_id': columns[1],
+                'address': columns[2],
+                'labels': columns[3].split(',') if len(columns) == 4 else []
+            })
+    return nodes
+
+def _parse_tokens_list(stdout):
+    '''
+    Parse the table printed by ``tctl tokens ls``
+    '''
+    tokens = []
+    append = tokens.append
+    # skip the column headings and the rule underneath them
+    for line in stdout.splitlines()[2:]:
+        columns = _columns(line)
+        if len(columns) == 3 and len(columns[0]) == 32:
+            append({
+                'token': columns[0],
+                'role': columns[1].split(','),
+                'expiry': columns[2]
+            })
+    return tokens
+
+def _parse_users_add(stdout):
+    '''
+    Parse the output of ``tctl users add``
+    '''
+    result = {}
+    # the group names double as the result keys
+    for match in _USERS_ADD_RE.finditer(stdout):
+        result[match.lastgroup] = match.group(match.lastgroup)
+    return result
+
+def _parse_users_list(stdout):
+    '''
+    Parse the table printed by ``tctl users ls``
+    '''
+    users = []
+    append = users.append
+    # skip the column headings and the rule underneath them
+    for line in stdout.splitlines()[2:]:
+        columns = _columns(line)
+        # _columns drops empty cells, so a user without logins has one
+        if len(columns) in (1, 2):
+            append({
+                'user': columns[0],
+                'allowed_logins': columns[1].split(',') if len(columns) == 2 else []
+            })
+    return users
+
 def version(failhard=True, ignore_retcode=False, redirect_stderr=False, debug=False, **kwargs):
     '''
     Get Teleport Version
@@ -38,11 +202,9 @@ def version(failhard=True, ignore_retcode=False, redirect_stderr=False, debug=Fa
         salt '*' teleport.version
     '''
     command = "tctl version"
-    cmd_result = __salt__['cmd.run_all'](
-        command,
-        cwd="/root",
-        runas="root",
-        python_shell=False,
+    err_key = 'stdout' if redirect_stderr else 'stderr'
+    cmd_result = _tctl(
+        ['version'],
         ignore_retcode=ignore_retcode,
         redirect_stderr=redirect_stderr,
         **kwargs)
@@ -51,7 +213,7 @@ def version(failhard=True, ignore_retcode=False, redirect_stderr=False, debug=Fa
     else:
         if failhard:
             msg = "Command '{0}' failed".format(command)
-            err = cmd_result['stdout' if redirect_stderr else 'stderr']
+            err = cmd_result[err_key]
             if err:
                 msg += ': {0}'.format(err)
             raise salt.exceptions.CommandExecutionError(msg)
@@ -80,6 +242,7 @@ def nodes_add(roles="node", ttl="2m", failhard=True, ignore_retcode=False, redir
     log.debug('teleport - tctl nodes add --roles={0} --ttl={1}'.format(roles, ttl))
 
     command = "tctl nodes add --roles={0} --ttl={1}".format(roles, ttl)
+    err_key = 'stdout' if redirect_stderr else 'stderr'
 
     cmd_result = __salt__['cmd.run_all'](
         command,
@@ -91,42 +254,16 @@ def nodes_add(roles="node", ttl="2m", failhard=True, ignore_retcode=False, redir
         **kwargs)
 
     if cmd_result['retcode'] == 0:
-        result = {}
+        result = _parse_nodes_add(cmd_result['stdout'])
 
         if debug:
             result['debug'] = cmd_result
 
-        token_regex  = re.compile(r'^The invite token: ([0-9a-f]{32})$')
-        expire_regex = re.compile(r'^  - This invitation token will expire in ([0-9]+) (.*)$')
-        cmd_regex    = re.compile(r'^> (.*)$')
-        auth_regex   = re.compile(r'.*--auth-server\=(.*)$')
-        
-        for line in cmd_result['stdout'].splitlines():
-            token_match  = token_regex.match(line)
-            expire_match = expire_regex.match(line)
-            cmd_match    = cmd_regex.match(line)
-            auth_match   = auth_regex.match(line)
-
-            if token_match:
-                result['token'] = token_match.group(1)
-            if expire_match:
-                result['expires'] = '{0} {1}'.format(expire_match.group(1), expire_match.group(2))
-                time_to_add = 0
-                if expire_match.group(2) == 'minutes':
-                    time_to_add = int(expire_match.group(1)) * 60
-                elif expire_match.group(2) == 'hours':
-                    time_to_add = int(expire_match.group(1)) * 60 * 60
-                result['expires_at'] = int(time.time()) + time_to_add
-            if cmd_match:
-                result['command'] = cmd_match.group(1)
-            if auth_match:
-                result['auth_server'] = auth_match.group(1)
-
         return result
     else:
         if failhard:
             msg = "Command '{0}' failed".format(command)
-            err = cmd_result['stdout' if redirect_stderr else 'stderr']
+            err = cmd_result[err_key]
             if err:
                 msg += ': {0}'.format(err)
             raise salt.exceptions.CommandExecutionError(msg)
@@ -145,40 +282,25 @@ def nodes_list(failhard=True, ignore_retcode=False, redirect_stderr=False, debug
     log.debug("teleport - tctl nodes ls")
 
     command = "tctl nodes ls"
+    err_key = 'stdout' if redirect_stderr else 'stderr'
 
-    cmd_result = __salt__['cmd.run_all'](
-        command,
-        cwd="/root",
-        runas="root",
-        python_shell=False,
+    cmd_result = _tctl(
+        ['nodes', 'ls'],
         ignore_retcode=ignore_retcode,
         redirect_stderr=redirect_stderr,
         **kwargs)
 
     if cmd_result['retcode'] == 0:
-        result = {'nodes': []}
+        result = {'nodes': _parse_nodes_list(cmd_result['stdout'])}
 
         if debug:
             result['debug'] = cmd_result
 
-        node_regex = re.compile('^([a-z\s]+)     (.*)     (.*)     (.*)$')
-            
-        for line in cmd_result['stdout'].splitlines():
-            parts = line.split('\t')
-            match = node_regex.match(line)
-            if match:
-                result['nodes'].append({
-                    'node_name': match.group(1),
-                    'node_id': match.group(2),
-                    'address': match.group(3),
-                    'labels': match.group(4).split(',')
-                })
-
         return result
     else:
         if failhard:
             msg = "Command '{0}' failed".format(command)
-            err = cmd_result['stdout' if redirect_stderr else 'stderr']
+            err = cmd_result[err_key]
             if err:
                 msg += ': {0}'.format(err)
             raise salt.exceptions.CommandExecutionError(msg)
@@ -198,39 +320,25 @@ def tokens_list(failhard=True, ignore_retcode=False, redirect_stderr=False, debu
     log.debug("teleport - tctl tokens ls")
 
     command = "tctl tokens ls"
+    err_key = 'stdout' if redirect_stderr else 'stderr'
 
-    cmd_result = __salt__['cmd.run_all'](
-        command,
-        cwd="/root",
-        runas="root",
-        python_shell=False,
+    cmd_result = _tctl(
+        ['tokens', 'ls'],
         ignore_retcode=ignore_retcode,
         redirect_stderr=redirect_stderr,
         **kwargs)
 
     if cmd_result['retcode'] == 0:
-        result = {'tokens': []}
+        result = {'tokens': _parse_tokens_list(cmd_result['stdout'])}
 
         if debug:
             result['debug'] = cmd_result
 
-        node_regex = re.compile('^([0-9a-f]{32})     (.*)     (.*)$')
-            
-        for line in cmd_result['stdout'].splitlines():
-            parts = line.split('\t')
-            match = node_regex.match(line)
-            if match:
-                result['tokens'].append({
-                    'token': match.group(1),
-                    'role': match.group(2).split(','),
-                    'expiry': match.group(3)
-                })
-
         return result
     else:
         if failhard:
             msg = "Command '{0}' failed".format(command)
-            err = cmd_result['stdout' if redirect_stderr else 'stderr']
+            err = cmd_result[err_key]
             if err:
                 msg += ': {0}'.format(err)
             raise salt.exceptions.CommandExecutionError(msg)
@@ -251,6 +359,7 @@ def users_add(login, local_logins=None, failhard=True, ignore_retcode=False, red
         salt '*' teleport.users_add ekristen local_logins="ekristen,erik"
     '''
     command = "tctl users add {0} {1}".format(login, local_logins)
+    err_key = 'stdout' if redirect_stderr else 'stderr'
 
     cmd_result = __salt__['cmd.run_all'](
         command,
@@ -262,6 +371,8 @@ def users_add(login, local_logins=None, failhard=True, ignore_retcode=False, red
         **kwargs)
 
     if cmd_result['retcode'] == 0:
+        _users_cache['data'] = None
+
         result = {
             'login': login,
             'result': True
@@ -273,21 +384,12 @@ def users_add(login, local_logins=None, failhard=True, ignore_retcode=False, red
         if debug:
             result['debug'] = cmd_result
 
-        expire_regex = re.compile(r'^Signup token has been created and is valid for (.*). Share this')
-        url_regex    = re.compile(r'^https://(.*)$')
-        
-        for line in cmd_result['stdout'].splitlines():
-            expire_match = expire_regex.match(line)
-            url_match    = url_regex.match(line)
-            if expire_match:
-                result['expires'] = expire_match.group(1)
-            if url_match:
-                result['url'] = "https://{0}".format(url_match.group(1))
+        result.update(_parse_users_add(cmd_result['stdout']))
         return result
     else:
         if failhard:
             msg = "Command '{0}' failed".format(command)
-            err = cmd_result['stdout' if redirect_stderr else 'stderr']
+            err = cmd_result[err_key]
             if err:
                 msg += ': {0}'.format(err)
             raise salt.exceptions.CommandExecutionError(msg)
@@ -305,6 +407,7 @@ def users_del(login, failhard=True, ignore_retcode=False, redirect_stderr=False,
         salt '*' teleport.users_del ekristen
     '''
     command = "tctl users del {0}".format(login)
+    err_key = 'stdout' if redirect_stderr else 'stderr'
 
     cmd_result = __salt__['cmd.run_all'](
         command,
@@ -316,6 +419,8 @@ def users_del(login, failhard=True, ignore_retcode=False, redirect_stderr=False,
         **kwargs)
 
     if cmd_result['retcode'] == 0:
+        _users_cache['data'] = None
+
         result = {
             'login': login,
             'result': True
@@ -325,63 +430,72 @@ def users_del(login, failhard=True, ignore_retcode=False, redirect_stderr=False,
     else:
         if failhard:
             msg = "Command '{0}' failed".format(command)
-            err = cmd_result['stdout' if redirect_stderr else 'stderr']
+            err = cmd_result[err_key]
             if err:
                 msg += ': {0}'.format(err)
             raise salt.exceptions.CommandExecutionError(msg)
         cmd_result['result'] = False
         return cmd_result
 
-def users_list(failhard=True, ignore_retcode=False, redirect_stderr=False, debug=False, **kwargs):
+def _list_users(failhard=True, ignore_retcode=False, redirect_stderr=False, debug=False, **kwargs):
     '''
-    List Teleport Users
+    Run ``tctl users ls`` and return the users_list result together with a
+    frozenset of the logins in it, or None for the set when tctl failed
 
-    CLI Example:
-
-    .. code-block:: bash
-
-        salt '*' teleport.users_list
+    The result may be the cached object itself and must not be mutated.
     '''
+    # only a plain listing is cached, anything that changes how tctl runs
+    # or what gets returned bypasses it
+    cacheable = (not debug and failhard and not ignore_retcode and not redirect_stderr
+                 and not salt.utils.args.clean_kwargs(**kwargs))
+    if cacheable and _users_cache['data'] is not None \
+            and time.monotonic() - _users_cache['ts'] < _USERS_CACHE_TTL:
+        return _users_cache['data']
+
     log.debug("teleport - tctl users ls")
 
     command = "tctl users ls"
+    err_key = 'stdout' if redirect_stderr else 'stderr'
 
-    cmd_result = __salt__['cmd.run_all'](
-        command,
-        cwd="/root",
-        runas="root",
-        python_shell=False,
+    cmd_result = _tctl(
+        ['users', 'ls'],
         ignore_retcode=ignore_retcode,
         redirect_stderr=redirect_stderr,
         **kwargs)
 
     if cmd_result['retcode'] == 0:
-        result = {'users': []}
+        result = {'users': _parse_users_list(cmd_result['stdout'])}
+        logins = frozenset(entry['user'] for entry in result['users'])
 
         if debug:
             result['debug'] = cmd_result
 
-        user_regex = re.compile('^(.*)     (.*)$')
-            
-        for line in cmd_result['stdout'].splitlines():
-            parts = line.split('\t')
-            match = user_regex.match(line)
-            if match:
-                result['users'].append({
-                    'user': match.group(1),
-                    'allowed_logins': match.group(2).split(',')
-                })
+        if cacheable:
+            _users_cache['data'] = (result, logins)
+            _users_cache['ts'] = time.monotonic()
 
-        return result
+        return result, logins
     else:
         if failhard:
             msg = "Command '{0}' failed".format(command)
-            err = cmd_result['stdout' if redirect_stderr else 'stderr']
+            err = cmd_result[err_key]
             if err:
                 msg += ': {0}'.format(err)
             raise salt.exceptions.CommandExecutionError(msg)
-        return cmd_result
-    
+        return cmd_result, None
+
+def users_list(failhard=True, ignore_retcode=False, redirect_stderr=False, debug=False, **kwargs):
+    '''
+    List Teleport Users
+
+    CLI Example:
+
+    .. code-block:: bash
+
+        salt '*' teleport.users_list
+    '''
+    # the listing may be the cached one, so never hand it out directly
+    return copy.deepcopy(_list_users(failhard, ignore_retcode, redirect_stderr, debug, **kwargs)[0])
 
 def users_exists(login):
     '''
@@ -393,11 +507,7 @@ def users_exists(login):
 
         salt '*' teleport.users_exists ekristen
     '''
-    existing_users = users_list()['users']
-    for entry in existing_users:
-        if entry['user'] == login:
-            return True
-    return False
+    return login in _list_users()[1]
 
 
 def node_authentication_token(tgt='*', roles='node', ttl='2m', expr_form='glob'):
@@ -411,35 +521,43 @@ def node_authentication_token(tgt='*', roles='node', ttl='2m', expr_form='glob')
     path_auth_token = '/var/lib/teleport/auth_token'
     path_node_key = '/var/lib/teleport/node.key'
 
-    authenticated = True
+    authenticated = False
+    auth_data = None
+    now = int(time.time())
 
-    if not os.path.exists(path_teleport_dir):
-      os.makedirs(path_teleport_dir)
+    os.makedirs(path_teleport_dir, exist_ok=True)
 
-    if __salt__['file.file_exists'](path_auth_token) == True:
+    # without node.key the node never joined, so any cached token is moot
+    if os.path.exists(path_node_key) and os.path.exists(path_auth_token):
         try:
             with salt.utils.flopen(path_auth_token, 'r+') as stream:
-                authData = yaml.load(stream)
-                if authData['expires_at'] < int(time.time()):
-                    authenticated = False
+                try:
+                    auth_data = json.load(stream)
+                except ValueError:
+                    # tokens cached by older releases were written as YAML,
+                    # convert them so the next run can read them as JSON
+                    stream.seek(0)
+                    auth_data = yaml.load(stream, Loader=_Loader)
+                    stream.seek(0)
+                    stream.truncate()
+                    json.dump(auth_data, stream)
+            authenticated = auth_data.get('expires_at', 0) >= now
         except Exception as e:
             log.error(e)
 
-    if __salt__['file.file_exists'](path_node_key) == False:
-        authenticated = False
-    else:
-        authenticated = True
-
     if authenticated == False:
         args = ['roles={0}'.format(roles), 'ttl={0}'.format(ttl)]
-        authentication_token = __salt__['publish.publish'](tgt, 'teleport.nodes_add', arg=args, expr_form=expr_form).values().pop()
+        pub_result = __salt__['publish.publish'](tgt, 'teleport.nodes_add', arg=args, expr_form=expr_form)
+        if not pub_result:
+            raise salt.exceptions.CommandExecutionError(
+                "No minion matching '{0}' returned a node token".format(tgt))
+        authentication_token = next(iter(pub_result.values()))
 
         log.debug('authentication_token: {0}'.format(authentication_token))
 
         with salt.utils.flopen(path_auth_token, 'w+') as stream:
-            yaml.dump(authentication_token, stream, default_flow_style=False)
+            json.dump(authentication_token, stream)
 
         return authentication_token['token']
     else:
-        with salt.utils.flopen(path_auth_token, 'r+') as stream:
-            return yaml.load(stream)['token']
+        return auth_data['token']
@@ -23,8 +23,17 @@ def __virtual__():
     else:
         return True
 
+def _existing_users():
+    '''
+    Return the set of Teleport logins, running tctl only once per state run
+    '''
+    if 'teleport.users' not in __context__:
+        __context__['teleport.users'] = set(
+            entry['user'] for entry in __salt__['teleport.users_list']()['users'])
+    return __context__['teleport.users']
+
 def user_present(name, local_logins=None):
-    if __salt__['teleport.users_exists'](name) == True:
+    if name in _existing_users():
         ret = {
             'name': name,
             'changes': None,
@@ -33,6 +42,7 @@ def user_present(name, local_logins=None):
         }
     else:
         teleport_user = __salt__['teleport.users_add'](name, local_logins)
+        __context__.pop('teleport.users', None)
         if teleport_user['result'] == True:
             ret = {
                 'name': name,
@@ -59,7 +69,7 @@ def user_present(name, local_logins=None):
     return ret
 
 def user_absent(name):
-    if __salt__['teleport.users_exists'](name) == False:
+    if name not in _existing_users():
         ret = {
             'name': name,
             'changes': None,
@@ -75,6 +85,7 @@ def user_absent(name):
         }
 
         teleport_user = __salt__['teleport.users_del'](name)
+        __context__.pop('teleport.users', None)
         if teleport_user['result'] == True:
             ret = {
                 'name': name,